@@ -1,15 +1,38 @@
 import os
-import glob
+import itertools
 import logging
+import re
 import sys
 from datetime import datetime
-from faster_whisper import WhisperModel
+# BatchedInferencePipeline 需要 faster-whisper >= 1.1
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from faster_whisper.vad import get_vad_model
 import subprocess
+import numpy as np
+from queue import Queue, Full
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
 from myai import get_summary
 
 # Set up base directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__)) + "/../"
 
+# 預先量化為 int8_float16 的 large-v3 模型目錄 (只需轉換一次)：
+#   pip install transformers[torch]
+#   ct2-transformers-converter --model openai/whisper-large-v3 --output_dir models/large-v3-int8_float16 \
+#       --quantization int8_float16 --copy_files tokenizer.json preprocessor_config.json
+# 目錄不存在時改從 Hugging Face 下載 large-v3
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "large-v3-int8_float16")
+
+# 批次解碼的音訊片段數，依 VRAM 調整 (large-v3 於 24GB 顯卡建議 8)
+BATCH_SIZE = 8
+
+# SRT 中只含空白、數字、.:,-> 的行 (序號、時間軸)，摘要時跳過
+SKIP_LINE_RE = re.compile(r'[\s0-9.:,>\-]*')
+
+# 同時送出的摘要請求數
+SUMMARY_WORKERS = 4
+
 # Create log directory if it doesn't exist
 LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "log")
 os.makedirs(LOG_DIR, exist_ok=True)
@@ -17,16 +40,8 @@ os.makedirs(LOG_DIR, exist_ok=True)
 # Set up logging
 log_file = os.path.join(LOG_DIR, f"scan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
 
-# Create custom StreamHandler with UTF-8 encoding
-class UTFStreamHandler(logging.StreamHandler):
-    def emit(self, record):
-        try:
-            msg = self.format(record)
-            stream = self.stream
-            stream.buffer.write(f"{msg}{self.terminator}".encode('utf-8'))
-            self.flush()
-        except Exception:
-            self.handleError(record)
+# 讓 stdout 直接以 UTF-8 輸出，預設的 StreamHandler 即可正確顯示日文/中文
+sys.stdout.reconfigure(encoding='utf-8')
 
 logging.basicConfig(
     level=logging.INFO,
@@ -34,48 +49,91 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S',
     handlers=[
         logging.FileHandler(log_file, encoding='utf-8'),
-        UTFStreamHandler(sys.stdout)
+        logging.StreamHandler(sys.stdout)
     ]
 )
 
-def extract_audio(video_path, audio_output_path):
-    """使用 ffmpeg 從影片檔案中提取音訊"""
+def load_audio(video_path):
+    """使用 ffmpeg 從影片檔案中提取 16kHz 單聲道音訊，直接讀入記憶體 (float32 ndarray)"""
     try:
-        subprocess.run(
-            ["ffmpeg", "-i", video_path, "-vn", "-acodec", "pcm_s16le", "-ar", "16000", 
-            "-ac", "1", audio_output_path],
+        proc = subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error",
+            "-i", video_path, "-vn", "-f", "s16le", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1", "-"],
             check=True,
-            capture_output=True
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
         )
-        logging.info(f"音訊已提取至: {audio_output_path}")
-        return True
+        audio = np.frombuffer(proc.stdout, np.int16).astype(np.float32) / 32768.0
+        logging.info(f"音訊已提取: {video_path} ({len(audio) / 16000:.1f} 秒)")
+        return audio
     except subprocess.CalledProcessError as e:
-        logging.error(f"提取音訊時發生錯誤: {e.stderr.decode()}")
-        return False
+        logging.error(f"提取音訊時發生錯誤: {e.stderr.decode(errors='replace')}")
+        return None
     except FileNotFoundError:
         logging.error("找不到 ffmpeg，請確保已安裝並添加到系統路徑。")
+        return None
+
+def iter_in_thread(iterable, maxsize=64):
+    """在背景執行緒消耗 iterable，讓 GPU 解碼與主執行緒的格式化重疊進行"""
+    q = Queue(maxsize=maxsize)
+    stop = Event()
+
+    def put(item):
+        # 消費端提早結束時 stop 會被設定，避免卡在已滿的佇列上而一直持有 generator
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
         return False
 
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            # 將例外 (例如 CUDA OOM) 交給主執行緒重新拋出
+            put(e)
+        finally:
+            put(None)
+
+    Thread(target=produce, daemon=True).start()
+    try:
+        for item in iter(q.get, None):
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
 def convert_to_srt(segments, output_path):
     """將 fast-whisper 的轉錄結果轉換為 SRT 字幕格式"""
     def format_time(t):
-        milliseconds = int(t * 1000) % 1000
-        seconds = int(t) % 60
-        minutes = int(t) // 60 % 60
-        hours = int(t) // 3600
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        for i, segment in enumerate(segments):
-            f.write(f"{i+1}\n")
-            f.write(f"{format_time(segment.start)} --> {format_time(segment.end)}\n")
-            f.write(f"{segment.text.strip()}\n\n")
-            logging.info(f"{format_time(segment.start)} --> {format_time(segment.end)} {segment.text.strip()}")
+        ms = int(round(t * 1000))
+        s, ms = divmod(ms, 1000)
+        m, s = divmod(s, 60)
+        h, m = divmod(m, 60)
+        return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+    lines = []
+    for i, segment in enumerate(iter_in_thread(segments)):
+        ts = f"{format_time(segment.start)} --> {format_time(segment.end)}"
+        text = segment.text.strip()
+        lines.append(f"{i+1}\n{ts}\n{text}\n\n")
+        logging.debug(f"{ts} {text}")
+
+    # 先寫入同目錄的 .tmp 再以 os.replace 原子性地改名，中斷時不會留下不完整的 srt
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write("".join(lines))
+    os.replace(temp_path, output_path)
     
     logging.info(f"字幕已儲存至: {output_path}")
     return True
 
-def do_srt(video_path):
+def do_srt(video_path, audio, pipeline):
     # 1. 檢查同名 srt 是否存在
     srt_path = os.path.splitext(video_path)[0] + ".srt"
     if os.path.exists(srt_path):
@@ -83,35 +141,27 @@ def do_srt(video_path):
         logging.info(f"字幕檔已存在，跳過處理: {srt_path}")
         return
 
-    # 3. 用 ffmpeg 將 mp4 轉為 temp.wav
-    temp_wav = os.path.splitext(video_path)[0] + ".temp.wav"
-    temp_srt = os.path.splitext(video_path)[0] + ".test.srt"
+    # 3. 音訊已由背景執行緒用 ffmpeg 讀入記憶體，提取失敗則跳過
+    if audio is None:
+        return
     
     try:
-        if not extract_audio(video_path, temp_wav):
-            return
-
-        # 4. 用 faster-whisper 將 temp.wav 轉為 test.srt
-        model = WhisperModel("large-v3", device="cuda", compute_type="float32")
-        segments, info = model.transcribe(temp_wav, beam_size=5, language="ja")
+        # 4. 用 faster-whisper 將音訊轉為同名 srt
+        # 批次模式預設 without_timestamps=True，每個字幕會變成最長 30 秒的整段，需關閉以保留逐句時間軸
+        segments, info = pipeline.transcribe(audio, beam_size=1, language="ja", batch_size=BATCH_SIZE,
+                                              without_timestamps=False,
+                                              vad_filter=True, vad_parameters=dict(min_silence_duration_ms=500))
         
         logging.info(f"偵測到的語言：'{info.language}'，可信度：{info.language_probability:.2f}")
         
-        if convert_to_srt(segments, temp_srt):
-            # 5. 若成功，rename test.srt 為同名 srt, unlink temp.wav
-            os.rename(temp_srt, srt_path)
-            os.unlink(temp_wav)
+        if convert_to_srt(segments, srt_path):
             logging.info(f"成功完成字幕轉換: {srt_path}")
     except Exception as e:
         logging.error(f"處理檔案時發生錯誤: {e}")
-    finally:
-        # 清理臨時檔案
-        logging.info(f"清理臨時檔案: {temp_wav}, {temp_srt}")
-        if os.path.exists(temp_wav):
-            os.unlink(temp_wav)
-        if os.path.exists(temp_srt):
-            os.unlink(temp_srt)
-        logging.info("清理完成")
+
+def bytelen(s):
+    """計算字串的 UTF-8 位元組長度，ASCII 字串不需編碼"""
+    return len(s) if s.isascii() else len(s.encode('utf-8'))
 
 def do_summary(video_path):
     logging.info(f"Processing summary for: {video_path}")
@@ -141,10 +191,10 @@ def do_summary(video_path):
         for line in content.split('\n'):
             # 若是 line 全部只有空白、數字、.:,->, 則跳過
             line = line.strip()
-            if all(c in ' 0123456789.:,->-' for c in line):
+            if SKIP_LINE_RE.fullmatch(line):
                 continue
 
-            line_size = len(line.encode('utf-8'))
+            line_size = bytelen(line)
             
             if current_size + line_size > MAX_BLOCK_SIZE and current_block:
                 blocks.append('\n'.join(current_block))
@@ -157,13 +207,10 @@ def do_summary(video_path):
         if current_block:
             blocks.append('\n'.join(current_block))
 
-        # 4. 對每個區塊調用 get_summary
-        summaries = []
-        for i, block in enumerate(blocks):
-            logging.info(f"處理區塊 {i+1}/{len(blocks)}")
-            summary = get_summary(block)
-            print(summary)
-            summaries.append(summary)
+        # 4. 對每個區塊平行調用 get_summary (網路 I/O)，map 保留區塊順序
+        logging.info(f"處理 {len(blocks)} 個區塊")
+        with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as executor:
+            summaries = list(executor.map(get_summary, blocks))
 
         # 5. 合併摘要並儲存
         final_summary = '\n\n'.join(summaries)
@@ -175,15 +222,61 @@ def do_summary(video_path):
     except Exception as e:
         logging.error(f"生成摘要時發生錯誤: {e}")
 
+def walk_mp4(root):
+    """逐一產生 root 底下的 mp4 檔案路徑，不需先列出整個目錄樹"""
+    # 與 glob 的 ** 相同：會進入符號連結的目錄、略過隱藏目錄與檔案，
+    # 副檔名大小寫依平台 (normcase 只在 Windows 轉小寫)
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if os.path.normcase(filename).endswith('.mp4') and not filename.startswith('.'):
+                yield os.path.join(dirpath, filename)
+
+def produce_audio(mp4_files, q):
+    """背景執行緒：預先提取下一個影片的音訊，讓 ffmpeg 與 GPU 轉錄同時進行"""
+    try:
+        for file in mp4_files:
+            audio = None
+            try:
+                audio = load_audio(file)
+            except Exception as e:
+                logging.error(f"提取音訊時發生錯誤: {file} - {e}")
+            q.put((file, audio))
+    finally:
+        q.put(None)
+
 def main():
     logging.info(f"Base directory: {BASE_DIR}")
-    mp4_files = glob.glob(os.path.join(BASE_DIR, "**/*.mp4"), recursive=True)
-    for (i, file) in enumerate(mp4_files):
+    # 先排除已有同名 srt 的影片，避免為它們提取音訊或載入模型
+    todo = (f for f in walk_mp4(BASE_DIR) if not os.path.exists(os.path.splitext(f)[0] + ".srt"))
+    first = next(todo, None)
+    if first is None:
+        logging.info("沒有待處理的影片")
+        return
+    todo = itertools.chain([first], todo)
+
+    # 只載入一次模型，所有影片共用
+    model_path = MODEL_DIR if os.path.isdir(MODEL_DIR) else "large-v3"
+    logging.info(f"載入模型: {model_path}")
+    model = WhisperModel(model_path, device="cuda", compute_type="int8_float16")
+    pipeline = BatchedInferencePipeline(model=model)
+    # 先以 1 秒靜音暖機實際使用的批次路徑，讓 CUDA kernel 初始化不計入第一個影片。
+    # 靜音會被 VAD 濾掉而不進解碼器，因此暖機時關閉 VAD 並指定 clip_timestamps，另外預先載入 VAD 模型
+    segments, _ = pipeline.transcribe(np.zeros(16000, dtype=np.float32), beam_size=1, language="ja",
+                                      batch_size=BATCH_SIZE, without_timestamps=False,
+                                      vad_filter=False, clip_timestamps=[{"start": 0, "end": 16000}])
+    list(segments)
+    get_vad_model()
+
+    # 音訊陣列佔用記憶體較大，佇列只保留一個預先提取的檔案
+    q = Queue(maxsize=1)
+    Thread(target=produce_audio, args=(todo, q), daemon=True).start()
+    for (i, (file, audio)) in enumerate(iter(q.get, None)):
         try:
-            logging.info(f"Processing file {i+1}/{len(mp4_files)}: {file}")
-            do_srt(file)
+            logging.info(f"Processing file {i+1}: {file}")
+            do_srt(file, audio, pipeline)
             # do_summary(file)
-            logging.info(f"Finished processing file {i+1}/{len(mp4_files)}: {file}")
+            logging.info(f"Finished processing file {i+1}: {file}")
         except Exception as e:
             logging.error(f"處理檔案時發生錯誤: {file} - {e}")
             continue  # 繼續處理下一個檔案
@@ -1,3 +1,3 @@
             # 若行中只包含空白、數字、.:,--> 這些字元，則跳過
-            if all(c in ' 0123456789.:,->-' for c in line):
+            if SKIP_LINE_RE.fullmatch(line):
                 continue
\ No newline at end of file
@@ -2,23 +2,24 @@ import faster_whisper
 import os
 import argparse
 import subprocess
+import numpy as np
 
 def convert_to_srt(segments, output_path):
     """將 fast-whisper 的轉錄結果轉換為 SRT 字幕格式。"""
+    # 將時間轉換為 SRT 格式 (HH:MM:SS,ms)
+    def format_time(t):
+        ms = int(round(t * 1000))
+        s, ms = divmod(ms, 1000)
+        m, s = divmod(s, 60)
+        h, m = divmod(m, 60)
+        return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
     srt_content = ""
     for i, segment in enumerate(segments):
         start_time = segment.start
         end_time = segment.end
         text = segment.text.strip()
 
-        # 將時間轉換為 SRT 格式 (HH:MM:SS,ms)
-        def format_time(seconds):
-            milliseconds = int(seconds * 1000) % 1000
-            seconds = int(seconds) % 60
-            minutes = int(seconds / 60) % 60
-            hours = int(seconds / 3600)
-            return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
-
         srt_content += f"{i+1}\n"
         srt_content += f"{format_time(start_time)} --> {format_time(end_time)}\n"
         srt_content += f"{text}\n\n"
@@ -27,28 +28,30 @@ def convert_to_srt(segments, output_path):
         f.write(srt_content)
     print(f"字幕已儲存至: {output_path}")
 
-def extract_audio(video_path, audio_output_path):
-    """使用 ffmpeg 從影片檔案中提取音訊。"""
+def load_audio(video_path):
+    """使用 ffmpeg 從影片檔案中提取 16kHz 單聲道音訊，直接讀入記憶體。"""
     try:
-        subprocess.run(
-            ["ffmpeg", "-i", video_path, "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1", audio_output_path],
+        proc = subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", video_path, "-vn", "-f", "s16le", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1", "-"],
             check=True,
-            capture_output=True
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
         )
-        print(f"音訊已提取至: {audio_output_path}")
-        return True
+        print(f"音訊已提取: {video_path}")
+        return np.frombuffer(proc.stdout, np.int16).astype(np.float32) / 32768.0
     except subprocess.CalledProcessError as e:
-        print(f"提取音訊時發生錯誤: {e.stderr.decode()}")
-        return False
+        print(f"提取音訊時發生錯誤: {e.stderr.decode(errors='replace')}")
+        return None
     except FileNotFoundError:
         print("找不到 ffmpeg，請確保已安裝並添加到系統路徑。")
-        return False
+        return None
 
-def transcribe_audio(audio_path, model_name, output_srt_path, language=None):
+def transcribe_audio(audio, model_name, output_srt_path, language=None, compute_type="default", beam_size=1):
     """使用 fast-whisper 轉錄音訊並保存為 SRT 檔案。"""
-    model = faster_whisper.WhisperModel(model_name)
+    model = faster_whisper.WhisperModel(model_name, compute_type=compute_type)
     try:
-        segments, info = model.transcribe(audio_path, beam_size=5, language=language)
+        segments, info = model.transcribe(audio, beam_size=beam_size, language=language,
+                                          vad_filter=True, vad_parameters=dict(min_silence_duration_ms=500))
         print(f"偵測到的語言：'{info.language}'，可信度：{info.language_probability:.2f}")
         convert_to_srt(segments, output_srt_path)
         return True
@@ -61,22 +64,25 @@ def main():
     parser.add_argument("input_file", help="輸入的音訊檔案 (.wav, .mp3 等) 或影片檔案 (.mp4, .mkv 等)。")
     parser.add_argument("-m", "--model", default="base", help="Whisper 模型大小 (tiny, base, small, medium, large-v1, large-v2, large-v3)。預設: base")
     parser.add_argument("-l", "--language", default=None, help="指定的語言代碼 (例如: en, zh)。如果未指定，將嘗試自動偵測。")
+    parser.add_argument("-c", "--compute_type", default="default", help="模型計算精度 (default, float16, int8_float16, int8, float32)。GPU 建議使用 float16 或 int8_float16。預設: default")
+    parser.add_argument("-b", "--beam_size", type=int, default=1, help="解碼的 beam 寬度，1 為 greedy 解碼 (最快)。預設: 1")
     args = parser.parse_args()
 
     input_file = args.input_file
     model_name = args.model
     language = args.language
+    compute_type = args.compute_type
+    beam_size = args.beam_size
 
     base, ext = os.path.splitext(input_file)
     output_srt_path = f"{base}.srt"
-    temp_audio_path = f"{base}_temp_audio.wav"
 
     if ext.lower() in [".mp4", ".mkv", ".mov", ".avi"]:
-        if extract_audio(input_file, temp_audio_path):
-            transcribe_audio(temp_audio_path, model_name, output_srt_path, language)
-            os.remove(temp_audio_path)  # 清理臨時音訊檔案
+        audio = load_audio(input_file)
+        if audio is not None:
+            transcribe_audio(audio, model_name, output_srt_path, language, compute_type, beam_size)
     elif ext.lower() in [".wav", ".mp3", ".ogg", ".flac"]:
-        transcribe_audio(input_file, model_name, output_srt_path, language)
+        transcribe_audio(input_file, model_name, output_srt_path, language, compute_type, beam_size)
     else:
         print(f"不支援的檔案格式: {ext}")
 